@@ -8,44 +8,48 @@ Licensed under the MIT License.
 """
 
 import argparse
+import importlib
+import io
 import os
 import re
-import shutil
-import tempfile
 import datetime
 import mimetypes
+import zlib
+from concurrent.futures import ProcessPoolExecutor, as_completed
 import sys
+import functools
+import email.errors
 import email.utils
 from pathlib import Path
 from email import policy
 from email.parser import BytesParser
-from xml.sax.saxutils import escape as xml_escape
 
 # --- Gestione Dipendenze ---
-try:
-    import pikepdf
-except ImportError:
-    sys.exit("ERRORE CRITICO: Libreria 'pikepdf' non trovata. Installa con: pip install pikepdf")
+# pikepdf, ReportLab, BeautifulSoup ed extract-msg sono importati solo nelle funzioni che li usano:
+# --help e gli errori sugli argomenti non pagano il costo di import (centinaia di ms).
+REQUIRED_LIBS = (("pikepdf", "pikepdf"), ("reportlab", "reportlab"), ("bs4", "beautifulsoup4"))
+
+def check_dependencies():
+    """Verifica le librerie obbligatorie prima di avviare l'elaborazione."""
+    for module, package in REQUIRED_LIBS:
+        try:
+            importlib.import_module(module)
+        except ImportError:
+            sys.exit(f"ERRORE CRITICO: Libreria '{package}' non trovata. Installa con: pip install {package}")
 
+# Parser HTML risolto una sola volta all'import (lxml è molto più veloce di html.parser)
 try:
-    from bs4 import BeautifulSoup
+    from lxml import etree, html as lxml_html
+    _HTML_PARSER = "lxml"
 except ImportError:
-    sys.exit("ERRORE CRITICO: Libreria 'beautifulsoup4' non trovata. Installa con: pip install beautifulsoup4")
+    etree = lxml_html = None
+    _HTML_PARSER = "html.parser"
 
-# Gestione opzionale MSG vecchio outlook
+# Parser HTML veloce opzionale (Lexbor, C); BeautifulSoup resta come fallback
 try:
-    import extract_msg
+    from selectolax.lexbor import LexborHTMLParser
 except ImportError:
-    extract_msg = None
-
-# Componenti ReportLab
-from reportlab.lib.pagesizes import A4
-from reportlab.lib.styles import getSampleStyleSheet, ParagraphStyle
-from reportlab.lib.units import mm
-from reportlab.platypus import SimpleDocTemplate, Paragraph, Spacer, HRFlowable
-from reportlab.pdfbase import pdfmetrics
-from reportlab.pdfbase.ttfonts import TTFont
-from reportlab.pdfbase.pdfmetrics import registerFontFamily
+    LexborHTMLParser = None
 
 # --- Costanti per PDF/A ---
 XMP_TEMPLATE = """<?xpacket begin="" id="W5M0MpCehiHzreSzNTczkc9d"?>
@@ -72,12 +76,49 @@ XMP_TEMPLATE = """<?xpacket begin="" id="W5M0MpCehiHzreSzNTczkc9d"?>
 </x:xmpmeta>
 <?xpacket end="w"?>"""
 
+# Template XMP pre-serializzato: frammenti bytes costanti alternati ai nomi dei campi
+_XMP_PARTS = tuple(
+    part.encode('utf-8') if i % 2 == 0 else part
+    for i, part in enumerate(re.split(r"\{(\w+)\}", XMP_TEMPLATE))
+)
+
 MONTHS_IT = {
     1: "gennaio", 2: "febbraio", 3: "marzo", 4: "aprile",
     5: "maggio", 6: "giugno", 7: "luglio", 8: "agosto",
     9: "settembre", 10: "ottobre", 11: "novembre", 12: "dicembre"
 }
 
+HEADER_ORDER = ("From", "To", "Cc", "Date", "Subject")
+
+# Regex compilate una volta sola: caratteri non ammessi / nome già pulito
+_SAFE_NAME_RE = re.compile(r"[^\w\-. ()\[\]]+", re.UNICODE)
+_SAFE_NAME_OK = re.compile(r"[\w\-. ()\[\]]*", re.UNICODE)
+# Caratteri di controllo non ammessi nei Paragraph di ReportLab (tab, LF e CR esclusi)
+_CTRL_RE = re.compile(r'[\x00-\x08\x0b\x0c\x0e-\x1f]')
+# Stessi caratteri come tabella per str.translate: più veloce della regex solo su testo ASCII puro
+_CTRL_TBL = dict.fromkeys([*range(0x00, 0x09), 0x0b, 0x0c, *range(0x0e, 0x20)])
+
+# Font TTF già registrati in ReportLab nel processo corrente: (regular, bold)
+_REGISTERED_FONTS: set[tuple] = set()
+
+# Escape XML (Paragraph di ReportLab e testo XMP) in un solo passaggio C (str.translate)
+_XML_ESC_TBL = str.maketrans({"&": "&amp;", "<": "&lt;", ">": "&gt;"})
+
+# Righe massime per Paragraph del corpo (meno di una pagina A4): un blocco enorme verrebbe ri-spezzato da ReportLab a ogni pagina
+BODY_BLOCK_LINES = 50
+
+# Spazio (pt) tra le righe del corpo: spaceAfter dei Paragraph a riga singola, inglobato nell'interlinea dei blocchi
+BODY_LINE_GAP = 6
+
+# Formati già compressi: embeddati così come sono, senza un passaggio Flate inutile
+_PRECOMPRESSED_EXTS = frozenset({
+    ".pdf", ".jpg", ".jpeg", ".png", ".zip",
+    ".docx", ".xlsx", ".pptx", ".odt", ".7z",
+})
+
+# Estensioni dei messaggi sorgente: file letti in batch, embeddati con AFRelationship /Source
+_SOURCE_EXTS = frozenset({".eml", ".msg"})
+
 # ---------------------------------------------------------------------
 # Utilities: Date & Stringhe (FIXED FOR STRICT VALIDATION)
 # ---------------------------------------------------------------------
@@ -85,25 +126,30 @@ MONTHS_IT = {
 def sanitize_filename(name: str, fallback: str = "file") -> str:
     """Pulisce i nomi dei file per compatibilità filesystem e PDF name trees."""
     name = (name or "").strip()
-    name = re.sub(r"[^\w\-. ()\[\]]+", "_", name, flags=re.UNICODE)
+    if not _SAFE_NAME_OK.fullmatch(name):
+        name = _SAFE_NAME_RE.sub("_", name)
     name = name.strip(" ._")
     return name[:250] if name else fallback
 
-def get_xmp_date() -> str:
-    """Costruisce manualmente la data XMP (YYYY-MM-DDThh:mm:ss+HH:MM)."""
-    now = datetime.datetime.now().astimezone()
-    offset_seconds = now.utcoffset().total_seconds()
-    sign = '+' if offset_seconds >= 0 else '-'
-    offset_seconds = abs(int(offset_seconds))
-    hours, remainder = divmod(offset_seconds, 3600)
-    minutes, _ = divmod(remainder, 60)
-    
-    date_part = now.strftime('%Y-%m-%dT%H:%M:%S')
-    tz_part = f"{sign}{hours:02d}:{minutes:02d}"
-    return f"{date_part}{tz_part}"
-
-def get_pdf_date() -> str:
-    """Costruisce manualmente la data PDF String (D:YYYYMMDDhhmmss+HH'mm')."""
+def make_unique_name(name: str, used: dict) -> str:
+    """Risolve le collisioni di nome (x, 1_x, 2_x, ...) in memoria, senza sondare il filesystem.
+
+    used mappa ogni nome già assegnato al prossimo contatore da provare per quel nome.
+    """
+    if name not in used:
+        used[name] = 1
+        return name
+    counter = used[name]
+    while f"{counter}_{name}" in used:
+        counter += 1
+    used[name] = counter + 1
+    unique = f"{counter}_{name}"
+    used[unique] = 1
+    return unique
+
+def get_pdfa_dates() -> tuple[str, str]:
+    """Costruisce manualmente, da un unico istante, la data XMP (YYYY-MM-DDThh:mm:ss+HH:MM)
+    e la data PDF String (D:YYYYMMDDhhmmss+HH'mm')."""
     now = datetime.datetime.now().astimezone()
     offset_seconds = now.utcoffset().total_seconds()
     sign = '+' if offset_seconds >= 0 else '-'
@@ -111,9 +157,9 @@ def get_pdf_date() -> str:
     hours, remainder = divmod(offset_seconds, 3600)
     minutes, _ = divmod(remainder, 60)
     
-    date_part = now.strftime('%Y%m%d%H%M%S')
-    tz_part = f"{sign}{hours:02d}'{minutes:02d}'"
-    return f"D:{date_part}{tz_part}"
+    xmp_date = f"{now.strftime('%Y-%m-%dT%H:%M:%S')}{sign}{hours:02d}:{minutes:02d}"
+    pdf_date = f"D:{now.strftime('%Y%m%d%H%M%S')}{sign}{hours:02d}'{minutes:02d}'"
+    return xmp_date, pdf_date
 
 def format_date_italian(date_str: str) -> str:
     """Converte l'header Date in formato leggibile italiano."""
@@ -127,25 +173,125 @@ def format_date_italian(date_str: str) -> str:
         hour = parsed.hour
         minute = parsed.minute
         return f"{day:02d} {month} {year}, {hour:02d}:{minute:02d}"
-    except Exception:
+    except (AttributeError, TypeError, ValueError):
         return date_str
 
+def raw_header(msg, name: str):
+    """Primo valore grezzo dell'header (compat32: byte 8-bit come surrogati), None se assente."""
+    name = name.lower()
+    for k, v in msg.raw_items():
+        if k.lower() == name:
+            return v
+    return None
+
+def decode_header_value(name: str, value) -> str:
+    """Decodifica un header grezzo compat32 con il parser della policy default (RFC 2047 e UTF-8 a 8 bit, RFC 6532)."""
+    if not value:
+        return ""
+    try:
+        return str(policy.default.header_fetch_parse(name, value))
+    except (LookupError, ValueError, email.errors.HeaderParseError):
+        return str(value)
+
+def get_part_filename(part):
+    """Come get_filename() della policy default (filename, poi name), ma sugli header grezzi compat32."""
+    for header, param in (("Content-Disposition", "filename"), ("Content-Type", "name")):
+        value = raw_header(part, header)
+        if value is None: continue
+        try:
+            filename = policy.default.header_fetch_parse(header, value).params.get(param)
+        except (LookupError, ValueError, email.errors.HeaderParseError):
+            continue
+        if filename:
+            return filename.strip()
+    return None
+
 # ---------------------------------------------------------------------
 # Parsing & Content Extraction
 # ---------------------------------------------------------------------
 
+HTML_STRIP_TAGS = ("script", "style", "noscript", "header", "footer", "meta", "link")
+
+# HTML banale (un solo blocco di testo tra tag innocui, senza entità): il testo si estrae senza parser.
+# Esclusi i tag il cui contenuto viene scartato o riscritto (link) dai parser; meta/link sono vuoti e ammessi.
+# Scansione lineare dei tag (nessun backtracking) e limite di dimensione: oltre si usa sempre il parser.
+TRIVIAL_HTML_MAX = 4096
+_HTML_TAG_RE = re.compile(r"<[^<>]*>")
+_HTML_TAG_NAME_RE = re.compile(r"</?([A-Za-z][\w-]*)")
+_TRIVIAL_SKIP_TAGS = frozenset({"a", "title", "textarea", "script", "style", "noscript", "header", "footer"})
+
+def _trivial_html_text(html: str):
+    """Testo di un HTML banale (un solo blocco di testo tra tag innocui, senza entità), None se serve il parser."""
+    if len(html) > TRIVIAL_HTML_MAX or "&" in html:
+        return None
+    chunks = []
+    pos = 0
+    for tag in _HTML_TAG_RE.finditer(html):
+        name = _HTML_TAG_NAME_RE.match(tag.group())
+        if name is not None and name.group(1).lower() in _TRIVIAL_SKIP_TAGS: return None
+        chunks.append(html[pos:tag.start()])
+        pos = tag.end()
+    chunks.append(html[pos:])
+    # Testo fuori dai tag: al più un blocco non vuoto e nessun '<' / '>' spaiato
+    texts = [c for c in chunks if c.strip()]
+    if len(texts) > 1 or (texts and ("<" in texts[0] or ">" in texts[0])):
+        return None
+    return texts[0].strip() if texts else ""
+
+def _html_to_text_lexbor(html: str) -> str:
+    """Estrazione testo via selectolax/Lexbor: un solo passaggio in C."""
+    tree = LexborHTMLParser(html)
+    for node in tree.css(",".join(HTML_STRIP_TAGS)):
+        node.decompose()
+    for a in tree.css("a[href]"):
+        # Come a.string di BeautifulSoup: si scende finché ogni livello ha un solo figlio (<a><span>testo</span></a>)
+        node = a.child
+        while node is not None and node.next is None and node.tag != "-text":
+            node = node.child
+        if node is not None and node.next is None and node.tag == "-text" and node.text():
+            # <a href> senza valore: Lexbor dà None, BeautifulSoup una stringa vuota
+            a.replace_with(f"{node.text()} ({a.attributes.get('href') or ''})")
+    # Tutto il documento, <head> compreso: come get_text() di BeautifulSoup anche il <title> resta nel testo
+    root = tree.root
+    return root.text(separator="\n").strip() if root is not None else ""
+
+def _html_to_text_lxml(html: str) -> str:
+    """Estrazione testo direttamente sull'albero lxml, senza i wrapper Python di BeautifulSoup."""
+    doc = lxml_html.fromstring(html)
+    # Rimozione dei tag (contenuto incluso, tail preservato) con una sola chiamata C
+    etree.strip_elements(doc, *HTML_STRIP_TAGS, with_tail=False)
+    for a in doc.iter("a"):
+        href = a.get("href")
+        if href is None: continue
+        # Come a.string di BeautifulSoup: si scende finché ogni livello ha un solo figlio (<a><span>testo</span></a>)
+        node = a
+        while len(node) == 1 and not node.text and not node[0].tail:
+            node = node[0]
+        if len(node) == 0 and node.text:
+            node.text = f"{node.text} ({href})"
+    return "\n".join(doc.itertext()).strip()
+
 def html_to_text(html: str) -> str:
     """Converte HTML in testo strutturato."""
     if not html: return ""
-    parser = "lxml"
-    try:
-        import lxml
-    except ImportError:
-        parser = "html.parser"
-    
+    trivial = _trivial_html_text(html)
+    if trivial is not None:
+        return trivial
+    if LexborHTMLParser is not None:
+        try:
+            return _html_to_text_lexbor(html)
+        except Exception as e:
+            print(f"Warning: Errore parsing HTML Lexbor ({e}), uso BeautifulSoup.", file=sys.stderr)
+    elif lxml_html is not None:
+        # Frammenti malformati (es. HTML vuoto) ricadono su BeautifulSoup
+        try:
+            return _html_to_text_lxml(html)
+        except Exception:
+            pass
     try:
-        soup = BeautifulSoup(html, parser)
-        for tag in soup(["script", "style", "noscript", "header", "footer", "meta", "link"]):
+        from bs4 import BeautifulSoup
+        soup = BeautifulSoup(html, _HTML_PARSER)
+        for tag in soup(list(HTML_STRIP_TAGS)):
             tag.decompose()
         for a in soup.find_all('a', href=True):
             if a.string:
@@ -155,101 +301,221 @@ def html_to_text(html: str) -> str:
         print(f"Warning: Errore parsing HTML ({e}), ritorno testo grezzo.", file=sys.stderr)
         return html
 
-def extract_text_from_eml(msg) -> str:
-    """Estrae il corpo del messaggio dando priorità all'HTML convertito."""
-    body_plain = ""
-    body_html = ""
-
-    def safe_decode(part):
-        try:
-            return part.get_content()
-        except Exception:
-            payload = part.get_payload(decode=True)
-            if not payload: return ""
-            for enc in ['utf-8', 'windows-1252', 'iso-8859-1']:
-                try: return payload.decode(enc)
-                except UnicodeDecodeError: continue
-            return payload.decode('utf-8', errors='replace')
-
-    if msg.is_multipart():
-        for part in msg.walk():
-            if part.get_content_disposition() == "attachment": continue
-            ctype = part.get_content_type()
-            if ctype == "text/plain":
-                body_plain += safe_decode(part)
-            elif ctype == "text/html":
-                body_html += html_to_text(safe_decode(part))
-    else:
-        ctype = msg.get_content_type()
-        content = safe_decode(msg)
-        if ctype == "text/html":
-            return html_to_text(content)
-        return content.strip()
-
-    return body_html.strip() if body_html.strip() else body_plain.strip()
+def decode_part_text(part) -> str:
+    """Decodifica il payload testuale di una parte MIME rispettandone il charset."""
+    payload = part.get_payload(decode=True)
+    if not payload: return ""
+    charset = part.get_content_charset()
+    if charset:
+        try: return payload.decode(charset, errors='replace')
+        except LookupError: pass
+    for enc in ['utf-8', 'windows-1252']:
+        try: return payload.decode(enc)
+        except UnicodeDecodeError: continue
+    return payload.decode('utf-8', errors='replace')
+
+def extract_body_and_attachments(msg, include_inline: bool):
+    """Visita l'albero MIME una sola volta: corpo (priorità all'HTML convertito) e allegati (nome, bytes) in memoria."""
+    body_plain_parts = []
+    body_html_parts = []
+    attachments = []
+    used_names = {}
+    multipart = msg.is_multipart()
+
+    for i, part in enumerate(msg.walk(), 1):
+        # I contenitori (multipart/*, message/rfc822) non hanno payload decodificabile:
+        # né corpo né allegato, inutile interrogarne gli header
+        if part.is_multipart(): continue
+
+        ctype = part.get_content_type()
+        disp = (part.get_content_disposition() or "").lower()
+        # Radice non testuale (es. PDF da gateway fax/scanner): nessun corpo, sempre embeddata come allegato
+        root_payload = not multipart and part.get_content_maintype() != "text"
+
+        if not multipart or disp != "attachment":
+            if ctype == "text/html":
+                body_html_parts.append(html_to_text(decode_part_text(part)))
+            elif ctype == "text/plain" or (not multipart and not root_payload):
+                body_plain_parts.append(decode_part_text(part))
+
+        if not root_payload and not include_inline and (disp == "inline" or part.get("Content-ID") is not None): continue
+        # Decodifica del nome (RFC 2047/2231, UTF-8 a 8 bit) solo per le parti candidate ad allegato
+        filename = get_part_filename(part)
+        if not filename and disp != "attachment" and not root_payload: continue
+
+        data = part.get_payload(decode=True)
+        if not data: continue
+
+        final_name = filename if filename else f"attachment_{i}.bin"
+        safe_name = sanitize_filename(final_name, f"att_{i}")
+        attachments.append((make_unique_name(safe_name, used_names), data))
+
+    body_html = "".join(body_html_parts).strip()
+    body_plain = "".join(body_plain_parts).strip()
+    return (body_html if body_html else body_plain), attachments
 
 # ---------------------------------------------------------------------
 # Generazione PDF Base (ReportLab)
 # ---------------------------------------------------------------------
 
-def create_pdf_from_data(pdf_path: Path, headers: dict, body_text: str, attachments: list, font_path: Path = None, font_bold_path: Path = None, font_size=10, margins=20):
-    """Genera il layout visivo del PDF."""
-    font_name = "Helvetica"
-    
-    if font_path and font_path.exists():
-        try:
-            pdfmetrics.registerFont(TTFont('CustomFont', str(font_path)))
-            font_name = 'CustomFont'
-            if font_bold_path and font_bold_path.exists():
-                pdfmetrics.registerFont(TTFont('CustomFont-Bold', str(font_bold_path)))
+@functools.lru_cache(maxsize=8)
+def _styles_for(font_name: str, font_size: int):
+    """Stili ReportLab costruiti una volta per (font, dimensione) e riusati nel batch."""
+    from reportlab.lib.styles import getSampleStyleSheet, ParagraphStyle
+    styles = getSampleStyleSheet()
+    body_style = ParagraphStyle('BodyStyle', parent=styles['Normal'], fontName=font_name, fontSize=font_size, leading=font_size*1.2, spaceAfter=BODY_LINE_GAP)
+    title_style = ParagraphStyle('TitleStyle', parent=styles['Title'], fontName=font_name)
+    # Intestazioni in un solo Paragraph: interlinea 14 = 12 (Normal) + i 2 punti di spaceAfter dei vecchi paragrafi per riga
+    header_lbl_style = ParagraphStyle('HeaderLbl', parent=styles['Normal'], fontName=font_name, fontSize=font_size, leading=14)
+    # Blocchi del corpo (righe unite con <br/>): interlinea = leading + lo spaceAfter dei paragrafi a riga singola
+    body_block_style = ParagraphStyle('BodyBlock', parent=body_style, leading=font_size*1.2 + BODY_LINE_GAP)
+    return body_style, title_style, header_lbl_style, body_block_style
+
+@functools.lru_cache(maxsize=None)
+def _body_block_paragraph():
+    """Paragraph per i blocchi del corpo con la stessa impaginazione di un Paragraph per riga.
+
+    Riceve le righe già escapate, nessuna delle quali va a capo. L'ultima riga del blocco porta in basso
+    BODY_LINE_GAP punti di interlinea che, come uno spaceAfter, non devono entrare nel frame:
+    altrimenti a fondo pagina starebbe una riga in meno.
+    """
+    from reportlab.platypus import Paragraph
+
+    class BodyBlockParagraph(Paragraph):
+        def __init__(self, lines, style):
+            self._body_lines = lines
+            super().__init__("<br/>".join(lines), style)
+
+        def wrap(self, availWidth, availHeight):
+            width, height = super().wrap(availWidth, availHeight + BODY_LINE_GAP)
+            return width, height - BODY_LINE_GAP
+
+        def split(self, availWidth, availHeight):
+            # Una riga sorgente = una riga stampata: si divide sulle righe, senza lo split di ReportLab
+            # che lascerebbe il <br/> in testa alla seconda parte (riga vuota a inizio pagina)
+            n = int((availHeight + BODY_LINE_GAP + 1e-8) / self.style.leading)
+            if n <= 0: return []
+            if n >= len(self._body_lines): return [self]
+            return [BodyBlockParagraph(self._body_lines[:n], self.style), BodyBlockParagraph(self._body_lines[n:], self.style)]
+
+        def drawOn(self, canvas, x, y, _sW=0):
+            super().drawOn(canvas, x, y - BODY_LINE_GAP, _sW)
+
+    return BodyBlockParagraph
+
+@functools.lru_cache(maxsize=8)
+def _static_flowables(font_name: str, font_size: int):
+    """Blocchi fissi del layout (titolo, intestazioni, separatori) già parsati, condivisi da tutti i PDF del batch.
+
+    Sono flowable a riga singola che non vengono mai spezzati: ReportLab li può ridisegnare
+    in più documenti senza doverne rieseguire il parsing XML.
+    """
+    from reportlab.platypus import Paragraph, HRFlowable
+    body_style, title_style, _, _ = _styles_for(font_name, font_size)
+    return {
+        "title": Paragraph("Archivio Email", title_style),
+        "body_heading": Paragraph("<b>Testo del messaggio:</b>", body_style),
+        "body_rule": HRFlowable(width="100%", thickness=0.5, color="grey"),
+        "attachments_heading": Paragraph("<b>Elenco allegati incorporati nel file:</b>", body_style),
+        "attachments_rule": HRFlowable(width="100%", thickness=1, color="black"),
+    }
+
+def register_custom_fonts(font_path: Path = None, font_bold_path: Path = None) -> str:
+    """Registra i TTF custom una sola volta per processo e ritorna il nome del font da usare."""
+    from reportlab.pdfbase import pdfmetrics
+    from reportlab.pdfbase.ttfonts import TTFont
+    from reportlab.pdfbase.pdfmetrics import registerFontFamily
+
+    if not (font_path and font_path.exists()):
+        return "Helvetica"
+    try:
+        has_bold = bool(font_bold_path and font_bold_path.exists())
+        font_key = (str(font_path.resolve()), str(font_bold_path.resolve()) if has_bold else None)
+        # Il parsing del TTF è costoso: in batch (e in ogni worker) si registra una sola volta
+        if font_key not in _REGISTERED_FONTS:
+            pdfmetrics.registerFont(TTFont('CustomFont', font_key[0]))
+            if has_bold:
+                pdfmetrics.registerFont(TTFont('CustomFont-Bold', font_key[1]))
                 registerFontFamily('CustomFont', normal='CustomFont', bold='CustomFont-Bold')
             else:
                 registerFontFamily('CustomFont', normal='CustomFont', bold='CustomFont')
-        except Exception as e:
-            print(f"Warning: Errore font custom ({e}). Uso Helvetica.")
+            _REGISTERED_FONTS.clear()
+            _REGISTERED_FONTS.add(font_key)
+        return 'CustomFont'
+    except Exception as e:
+        # Un TTF troncato o corrotto può sollevare di tutto (TTFError, struct.error, KeyError, ...): si ripiega su Helvetica
+        print(f"Warning: Errore font custom ({e}). Uso Helvetica.")
+        return "Helvetica"
+
+def create_pdf_from_data(pdf_path: Path | io.BytesIO, headers: dict, body_text: str, attachments: list, font_path: Path = None, font_bold_path: Path = None, font_size=10, margins=20):
+    """Genera il layout visivo del PDF (su file o su buffer in memoria)."""
+    from reportlab.lib.pagesizes import A4
+    from reportlab.lib.units import mm
+    from reportlab.platypus import SimpleDocTemplate, Paragraph, Spacer
+    from reportlab.pdfbase.pdfmetrics import stringWidth
+
+    font_name = register_custom_fonts(font_path, font_bold_path)
     
     m = margins * mm
-    doc = SimpleDocTemplate(str(pdf_path), pagesize=A4, rightMargin=m, leftMargin=m, topMargin=m, bottomMargin=m)
-    styles = getSampleStyleSheet()
+    doc = SimpleDocTemplate(pdf_path if isinstance(pdf_path, io.BytesIO) else str(pdf_path), pagesize=A4, rightMargin=m, leftMargin=m, topMargin=m, bottomMargin=m)
+    body_style, _, header_lbl_style, body_block_style = _styles_for(font_name, font_size)
+    static = _static_flowables(font_name, font_size)
     
-    body_style = ParagraphStyle('BodyStyle', parent=styles['Normal'], fontName=font_name, fontSize=font_size, leading=font_size*1.2, spaceAfter=6)
-    title_style = ParagraphStyle('TitleStyle', parent=styles['Title'], fontName=font_name)
-    header_lbl_style = ParagraphStyle('HeaderLbl', parent=styles['Normal'], fontName=font_name, fontSize=font_size, spaceAfter=2)
+    story = [static["title"], Spacer(1, 10*mm)]
     
-    story = [Paragraph("Archivio Email", title_style), Spacer(1, 10*mm)]
-    
-    header_order = ["From", "To", "Cc", "Date", "Subject"]
-    for k in header_order:
+    # Tutte le intestazioni in un unico Paragraph (righe unite con <br/>)
+    header_lines = []
+    for k in HEADER_ORDER:
         v = headers.get(k, "")
         if v:
             if k == "Date": v = format_date_italian(v)
-            clean_v = xml_escape(str(v))
-            txt = f"<b>{k}:</b> {clean_v}"
-            story.append(Paragraph(txt, header_lbl_style))
+            clean_v = str(v).translate(_XML_ESC_TBL)
+            header_lines.append(f"<b>{k}:</b> {clean_v}")
+    if header_lines:
+        story.append(Paragraph("<br/>".join(header_lines), header_lbl_style))
             
     story.append(Spacer(1, 10*mm))
-    story.append(HRFlowable(width="100%", thickness=0.5, color="grey"))
+    story.append(static["body_rule"])
     story.append(Spacer(1, 5*mm))
-    story.append(Paragraph("<b>Testo del messaggio:</b>", body_style))
+    story.append(static["body_heading"])
     
     if body_text:
-        body_text = re.sub(r'[\x00-\x08\x0b\x0c\x0e-\x1f]', '', body_text)
+        body_text = body_text.translate(_CTRL_TBL) if body_text.isascii() else _CTRL_RE.sub('', body_text)
+        # Un Paragraph per blocco di righe (unite con <br/>, al massimo BODY_BLOCK_LINES) invece di uno per riga.
+        # Le righe più larghe del frame (padding 6 pt per lato) vanno a capo: restano un Paragraph a sé,
+        # così le righe spezzate mantengono l'interlinea originale invece di quella del blocco.
+        wrap_width = doc.width - 12
+        BodyBlockParagraph = _body_block_paragraph()
+        block = []
         for line in body_text.splitlines():
-            if not line.strip():
+            blank = not line.strip()
+            wraps = not blank and stringWidth(line, font_name, font_size) > wrap_width
+            if not blank and not wraps:
+                block.append(line.translate(_XML_ESC_TBL))
+                if len(block) < BODY_BLOCK_LINES: continue
+            if block:
+                story.append(BodyBlockParagraph(block, body_block_style))
+                block = []
+            if wraps:
+                story.append(Paragraph(line.translate(_XML_ESC_TBL), body_style))
+            elif blank:
                 story.append(Spacer(1, 2*mm))
-                continue
-            clean_line = xml_escape(line)
-            story.append(Paragraph(clean_line, body_style))
+        if block:
+            story.append(BodyBlockParagraph(block, body_block_style))
             
     if attachments:
         story.append(Spacer(1, 10*mm))
-        story.append(HRFlowable(width="100%", thickness=1, color="black"))
+        story.append(static["attachments_rule"])
         story.append(Spacer(1, 5*mm))
-        story.append(Paragraph("<b>Elenco allegati incorporati nel file:</b>", body_style))
-        for f in attachments:
-            try: size_kb = os.path.getsize(f) // 1024
-            except OSError: size_kb = 0
-            clean_fname = xml_escape(f.name)
+        story.append(static["attachments_heading"])
+        for fname, data in attachments:
+            # Gli allegati estratti sono già in memoria: niente stat, la dimensione è len(data)
+            if isinstance(data, Path):
+                try: size_kb = data.stat().st_size // 1024
+                except OSError: size_kb = 0
+            else:
+                size_kb = len(data) // 1024
+            clean_fname = fname.translate(_XML_ESC_TBL)
             story.append(Paragraph(f"• {clean_fname} ({size_kb} KB)", body_style))
             
     doc.build(story)
@@ -258,62 +524,90 @@ def create_pdf_from_data(pdf_path: Path, headers: dict, body_text: str, attachme
 # Pipeline PDF/A (Pikepdf)
 # ---------------------------------------------------------------------
 
-def generate_pdfa_metadata(pdf_path: Path) -> bytes:
+def generate_pdfa_metadata(pdf_path: Path, xmp_date: str) -> bytes:
     """Genera XML XMP valido con formattazione rigorosa della data."""
-    xmp_date = get_xmp_date()
-    safe_title = xml_escape(os.path.basename(pdf_path))
-    safe_author = xml_escape("EML to PDF Converter")
+    safe_title = os.path.basename(pdf_path).translate(_XML_ESC_TBL)
     
-    meta_xml = XMP_TEMPLATE.format(
-        title=safe_title,
-        author=safe_author,
-        created_date=xmp_date,
-        mod_date=xmp_date,
-        keywords="email, archive, pdf-a, legal"
+    values = {
+        "title": safe_title.encode('utf-8'),
+        "author": b"EML to PDF Converter",
+        "created_date": xmp_date.encode('ascii'),
+        "mod_date": xmp_date.encode('ascii'),
+        "keywords": b"email, archive, pdf-a, legal",
+    }
+    return b"".join(
+        part if isinstance(part, bytes) else values[part] for part in _XMP_PARTS
     )
-    return meta_xml.encode('utf-8')
 
-def finalize_pdf_with_attachments(pdf_in: Path, pdf_out: Path, files_to_attach: list, icc_profile_path: Path = None):
-    """Step finale: Embedding file, iniezione ICC, XMP, PDF/A ID."""
+@functools.lru_cache(maxsize=None)
+def _pdf_name(name: str):
+    """Name pikepdf costruito una volta e riusato (Subtype MIME, AFRelationship, ...)."""
+    import pikepdf
+    return pikepdf.Name(name)
+
+def finalize_pdf_with_attachments(pdf_in: Path | io.BytesIO, pdf_out: Path, files_to_attach: list, icc_profile_path: Path = None):
+    """Step finale: Embedding file, iniezione ICC, XMP, PDF/A ID.
+
+    files_to_attach contiene tuple (nome, dati): i dati sono bytes già in memoria
+    oppure un Path letto solo al momento dell'embedding. La lista viene consumata:
+    ogni allegato si libera appena copiato nello stream qpdf, così il picco di memoria
+    non contiene ogni file due volte.
+    """
+    import pikepdf
+
     with pikepdf.open(pdf_in) as pdf:
         
-        embedded_files_data = []
-        pdf_date_str = get_pdf_date()
+        # Filespec per nome: il name tree /EmbeddedFiles richiede chiavi univoche
+        embedded_files_data = {}
+        used_names = {}
+        xmp_date_str, pdf_date_str = get_pdfa_dates()
         
-        for f in files_to_attach:
-            if not f.exists(): continue
-            try: file_data = f.read_bytes()
-            except IOError: continue
+        files_to_attach.reverse()
+        while files_to_attach:
+            name, data = files_to_attach.pop()
+            if isinstance(data, Path):
+                try: file_data = data.read_bytes()
+                except OSError: continue
+            else:
+                file_data = data
             
-            mime_type, _ = mimetypes.guess_type(f.name)
-            if not mime_type: mime_type = "application/octet-stream"
+            ext = os.path.splitext(name)[1].lower()
+            mime_type = mimetypes.guess_type(name)[0] or "application/octet-stream"
             
-            ef_stream = pdf.make_stream(file_data)
+            file_size = len(file_data)
+            if ext in _PRECOMPRESSED_EXTS:
+                ef_stream = pdf.make_stream(file_data)
+            else:
+                ef_stream = pdf.make_stream(zlib.compress(file_data))
+                ef_stream.Filter = pikepdf.Name("/FlateDecode")
+            file_data = data = None
             ef_stream.Type = pikepdf.Name("/EmbeddedFile")
-            ef_stream.Subtype = pikepdf.Name("/" + mime_type)
+            ef_stream.Subtype = _pdf_name("/" + mime_type)
             ef_stream.Params = pikepdf.Dictionary({
-                "/Size": len(file_data),
+                "/Size": file_size,
                 "/ModDate": pikepdf.String(pdf_date_str),
                 "/CreationDate": pikepdf.String(pdf_date_str)
             })
             
-            safe_fname = sanitize_filename(f.name)
+            # Il sorgente può avere lo stesso nome di un allegato: collisione risolta come per gli allegati
+            safe_fname = make_unique_name(sanitize_filename(name), used_names)
             fs = pikepdf.Dictionary({
                 "/Type": pikepdf.Name("/Filespec"),
                 "/F": pikepdf.String(safe_fname),
                 "/UF": pikepdf.String(safe_fname),
                 "/EF": pikepdf.Dictionary({"/F": ef_stream}),
-                "/AFRelationship": pikepdf.Name("/Source") if f.suffix.lower() in [".eml", ".msg"] else pikepdf.Name("/Data"),
+                "/AFRelationship": _pdf_name("/Source" if ext in _SOURCE_EXTS else "/Data"),
                 "/Desc": pikepdf.String(safe_fname)
             })
-            embedded_files_data.append((safe_fname, pdf.make_indirect(fs)))
+            embedded_files_data[safe_fname] = pdf.make_indirect(fs)
             
         if "/Names" not in pdf.Root: pdf.Root.Names = pikepdf.Dictionary()
         
         name_array = pikepdf.Array()
         af_array = pikepdf.Array()
         
-        for fname, fs_ref in sorted(embedded_files_data, key=lambda x: x[0]):
+        for fname in sorted(embedded_files_data):
+            fs_ref = embedded_files_data[fname]
             name_array.append(pikepdf.String(fname))
             name_array.append(fs_ref)
             af_array.append(fs_ref) 
@@ -321,13 +615,14 @@ def finalize_pdf_with_attachments(pdf_in: Path, pdf_out: Path, files_to_attach:
         pdf.Root.Names.EmbeddedFiles = pikepdf.Dictionary({"/Names": name_array})
         pdf.Root["/AF"] = af_array
 
-        metadata_stm = pdf.make_stream(generate_pdfa_metadata(pdf_in))
+        metadata_stm = pdf.make_stream(generate_pdfa_metadata(pdf_out, xmp_date_str))
         metadata_stm.Type = pikepdf.Name("/Metadata")
         metadata_stm.Subtype = pikepdf.Name("/XML")
         pdf.Root.Metadata = metadata_stm
 
         if icc_profile_path and icc_profile_path.exists():
-            icc_stream = pdf.make_stream(icc_profile_path.read_bytes())
+            icc_stream = pdf.make_stream(zlib.compress(icc_profile_path.read_bytes()))
+            icc_stream.Filter = pikepdf.Name("/FlateDecode")
             icc_stream.N = 3
             icc_stream.Alternate = pikepdf.Name("/DeviceRGB")
             
@@ -342,10 +637,18 @@ def finalize_pdf_with_attachments(pdf_in: Path, pdf_out: Path, files_to_attach:
 
         # FIX: Disabilitiamo l'auto-update del Producer da parte di Pikepdf per evitare il warning
         with pdf.open_metadata(set_pikepdf_as_editor=False) as meta:
-            meta["dc:title"] = os.path.basename(pdf_in)
+            meta["dc:title"] = os.path.basename(pdf_out)
             meta["pdf:Producer"] = "EML to PDF/A Converter"
 
-        pdf.save(pdf_out, fix_metadata_version=True)
+        # Object stream (ammessi in PDF/A-2/3) e nessuna ridecodifica degli stream già compressi da ReportLab.
+        # La compressione Flate è già applicata sopra solo dove serve: qpdf non ricomprime gli allegati.
+        pdf.save(
+            pdf_out,
+            fix_metadata_version=True,
+            object_stream_mode=pikepdf.ObjectStreamMode.generate,
+            compress_streams=False,
+            stream_decode_level=pikepdf.StreamDecodeLevel.none,
+        )
 
 # ---------------------------------------------------------------------
 # Logica Principale
@@ -353,82 +656,69 @@ def finalize_pdf_with_attachments(pdf_in: Path, pdf_out: Path, files_to_attach:
 
 def process_file(input_path: Path, out_pdf: Path, font_p: Path, font_bold_p: Path, font_size: int, margins: int, include_inline: bool, embed_orig: bool, icc_path: Path):
     ext = input_path.suffix.lower()
-    
-    with tempfile.TemporaryDirectory(prefix="eml2pdf_proc_") as tmp_dir:
-        tmp_path = Path(tmp_dir)
-        att_dir = tmp_path / "attachments"
-        att_dir.mkdir()
-        
-        attachments_paths = []
-        headers = {}
-        body = ""
 
-        if ext == ".eml":
-            try:
-                msg = BytesParser(policy=policy.default).parsebytes(input_path.read_bytes())
-            except Exception as e:
-                raise ValueError(f"File EML illeggibile: {e}")
+    attachments = []
+    headers = {}
+    body = ""
 
-            headers = {k: str(msg.get(k, "")) for k in ["From", "To", "Cc", "Date", "Subject"]}
-            
-            for i, part in enumerate(msg.walk(), 1):
-                filename = part.get_filename()
-                disp = (part.get_content_disposition() or "").lower()
-                is_inline = (disp == "inline") or (part.get("Content-ID") is not None)
-                if is_inline and not include_inline: continue
-                if not filename and disp != "attachment": continue
-                
-                data = part.get_payload(decode=True)
-                if not data: continue
-                
-                final_name = filename if filename else f"attachment_{i}.bin"
-                safe_name = sanitize_filename(final_name, f"att_{i}")
-                dest = att_dir / safe_name
-                counter = 1
-                while dest.exists():
-                    dest = att_dir / f"{counter}_{safe_name}"
-                    counter += 1
-                dest.write_bytes(data)
-                attachments_paths.append(dest)
-            
-            body = extract_text_from_eml(msg)
-
-        elif ext == ".msg":
-            if not extract_msg: raise ImportError("Libreria 'extract-msg' mancante.")
-            try:
-                msg = extract_msg.Message(str(input_path))
-                headers = {"From": getattr(msg, 'sender', ''), "To": getattr(msg, 'to', ''), "Cc": getattr(msg, 'cc', ''), "Date": getattr(msg, 'date', ''), "Subject": getattr(msg, 'subject', '')}
-                raw_body = msg.htmlBody
-                if raw_body:
-                    if isinstance(raw_body, bytes): raw_body = raw_body.decode('utf-8', errors='ignore')
-                    body = html_to_text(raw_body)
-                else:
-                    body = msg.body or ""
-
-                for i, att in enumerate(msg.attachments):
-                    if not include_inline and getattr(att, 'cid', None): continue
-                    fname = getattr(att, 'longFilename', None) or getattr(att, 'shortFilename', None) or f"att_{i}"
-                    safe_name = sanitize_filename(fname)
-                    dest = att_dir / safe_name
-                    counter = 1
-                    while dest.exists():
-                        dest = att_dir / f"{counter}_{safe_name}"
-                        counter += 1
-                    dest.write_bytes(att.data)
-                    attachments_paths.append(dest)
-                msg.close()
-            except Exception as e: raise ValueError(f"Errore MSG: {e}")
-
-        all_to_embed = []
-        if embed_orig:
-            orig_copy = tmp_path / sanitize_filename(input_path.name, f"source{ext}")
-            shutil.copy2(input_path, orig_copy)
-            all_to_embed.append(orig_copy)
+    if ext == ".eml":
+        try:
+            # Parsing in streaming dal file: niente copia completa dei byte grezzi in memoria
+            with open(input_path, 'rb') as fh:
+                msg = BytesParser(policy=policy.compat32).parse(fh)
+        except Exception as e:
+            raise ValueError(f"File EML illeggibile: {e}")
+
+        headers = {k: decode_header_value(k, raw_header(msg, k)) for k in HEADER_ORDER}
         
-        all_to_embed.extend(attachments_paths)
-        intermediate_pdf = tmp_path / "layout_temp.pdf"
-        create_pdf_from_data(intermediate_pdf, headers, body, all_to_embed, font_p, font_bold_p, font_size, margins)
-        finalize_pdf_with_attachments(intermediate_pdf, out_pdf, all_to_embed, icc_path)
+        body, attachments = extract_body_and_attachments(msg, include_inline)
+        # L'albero MIME (payload ancora codificati) non serve più
+        del msg
+
+    elif ext == ".msg":
+        try:
+            import extract_msg
+        except ImportError:
+            raise ImportError("Libreria 'extract-msg' mancante.")
+        try:
+            msg = extract_msg.Message(str(input_path))
+            headers = {"From": getattr(msg, 'sender', ''), "To": getattr(msg, 'to', ''), "Cc": getattr(msg, 'cc', ''), "Date": getattr(msg, 'date', ''), "Subject": getattr(msg, 'subject', '')}
+            raw_body = msg.htmlBody
+            if raw_body:
+                if isinstance(raw_body, bytes): raw_body = raw_body.decode('utf-8', errors='ignore')
+                body = html_to_text(raw_body)
+            else:
+                body = msg.body or ""
+
+            used_names = {}
+            for i, att in enumerate(msg.attachments):
+                if not include_inline and getattr(att, 'cid', None): continue
+                fname = getattr(att, 'longFilename', None) or getattr(att, 'shortFilename', None) or f"att_{i}"
+                safe_name = sanitize_filename(fname)
+                attachments.append((make_unique_name(safe_name, used_names), att.data))
+            msg.close()
+        except Exception as e: raise ValueError(f"Errore MSG: {e}")
+
+    all_to_embed = []
+    if embed_orig:
+        # Il sorgente viene letto in place al momento dell'embedding: nessuna copia temporanea
+        all_to_embed.append((sanitize_filename(input_path.name, f"source{ext}"), input_path))
+    
+    all_to_embed.extend(attachments)
+    del attachments
+    # Layout ReportLab in memoria, passato direttamente a pikepdf senza PDF intermedio su disco
+    layout_pdf = io.BytesIO()
+    create_pdf_from_data(layout_pdf, headers, body, all_to_embed, font_p, font_bold_p, font_size, margins)
+    layout_pdf.seek(0)
+    finalize_pdf_with_attachments(layout_pdf, out_pdf, all_to_embed, icc_path)
+
+def _process_job(job: tuple):
+    """Worker (top-level, quindi picklabile) per il batch parallelo: ritorna (file, errore o None)."""
+    try:
+        process_file(*job)
+        return job[0], None
+    except Exception as e:
+        return job[0], str(e)
 
 def main():
     ap = argparse.ArgumentParser(description="EML/MSG to PDF/A-3b Converter (Legal Archive Ready)")
@@ -442,6 +732,7 @@ def main():
     ap.add_argument("--batch", action="store_true", help="Elabora cartella intera")
     ap.add_argument("--no-embed-orig", action="store_true", help="Escludi file sorgente dall'embedding")
     ap.add_argument("--exclude-inline", action="store_true", help="Escludi oggetti inline come allegati")
+    ap.add_argument("-j", "--jobs", type=int, default=os.cpu_count() or 1, help="Processi paralleli in modalità batch (default: numero di CPU)")
     
     args = ap.parse_args()
     ip = Path(args.input_path).resolve()
@@ -450,12 +741,14 @@ def main():
     fbp = Path(args.font_bold).resolve() if args.font_bold else None
 
     if not icc.exists(): sys.exit(f"ERRORE: Profilo ICC non trovato in {icc}")
+    check_dependencies()
     
     files = []
     if args.batch:
         if not ip.is_dir(): sys.exit("Errore: input batch deve essere cartella")
-        files.extend(ip.glob("*.eml"))
-        files.extend(ip.glob("*.msg"))
+        # Una sola scansione della cartella, estensione senza distinzione maiuscole/minuscole (.EML)
+        # Ordinati: l'assegnazione dei nomi di output in caso di collisione resta deterministica
+        files = sorted(p for p in ip.iterdir() if p.suffix.lower() in _SOURCE_EXTS)
         if not files: sys.exit("Nessun file trovato")
     else:
         if not ip.is_file(): sys.exit("Errore: file input non trovato")
@@ -467,16 +760,39 @@ def main():
 
     success, fail = 0, 0
     print(f"Elaborazione {len(files)} files...")
-    for f in files:
-        target = out_base / (f.stem + ".pdf") if args.batch else (out_base if str(out_base).lower().endswith(".pdf") else out_base / (f.stem + ".pdf"))
-        print(f" -> {f.name}...", end=" ", flush=True)
-        try:
-            process_file(f, target, fp, fbp, args.font_size, args.margins, not args.exclude_inline, not args.no_embed_orig, icc)
-            print("OK")
+    def report(f: Path, err: str | None):
+        nonlocal success, fail
+        if err is None:
+            print(f" -> {f.name}... OK", flush=True)
             success += 1
-        except Exception as e:
-            print(f"FAIL: {e}")
+        else:
+            print(f" -> {f.name}... FAIL: {err}", flush=True)
             fail += 1
+
+    jobs = []
+    used = set()
+    for f in files:
+        target = out_base / (f.stem + ".pdf") if args.batch else (out_base if str(out_base).lower().endswith(".pdf") else out_base / (f.stem + ".pdf"))
+        # a.eml + a.msg (o a.EML) darebbero lo stesso a.pdf, scritto in parallelo: si ripiega su a.eml.pdf
+        if str(target).casefold() in used:
+            target = out_base / (f.name + ".pdf")
+        if str(target).casefold() in used:
+            report(f, f"output duplicato {target.name}")
+            continue
+        used.add(str(target).casefold())
+        jobs.append((f, target, fp, fbp, args.font_size, args.margins, not args.exclude_inline, not args.no_embed_orig, icc))
+
+    # Ogni file è indipendente (PDF proprio, nessuno stato condiviso): in batch si usa un pool di processi
+    workers = max(1, min(args.jobs, len(jobs)))
+    if workers > 1:
+        with ProcessPoolExecutor(max_workers=workers) as ex:
+            futures = [ex.submit(_process_job, job) for job in jobs]
+            # Esito stampato appena ogni file termina, non a fine batch
+            for fut in as_completed(futures):
+                report(*fut.result())
+    else:
+        for job in jobs:
+            report(*_process_job(job))
     sys.exit(1 if fail > 0 else 0)
 
 if __name__ == "__main__":